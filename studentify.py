@@ -13,13 +13,17 @@
 # useful imports
 
 import argparse
+import hashlib
 import os
 import shutil
 import sys
 import tempfile
-from collections import namedtuple
-from functools import partial, reduce
+from types import SimpleNamespace
+from collections import Counter, namedtuple
+from functools import lru_cache, partial, reduce
 
+LARGE_FILE_BUFFER_SIZE = 1 << 20  # 1 MiB read/write buffers for --largeFile
+TEMP_FILE_PREFIX = '.studentify_'  # temporary files, skipped by the shard walks
 TOKEN_TYPES = {'delete': '!!', 'comment': '??', 'replace': '++', 'student': '::'}
 LangInfo = namedtuple('LangInfo', 'name, extensions, comment_symbol, tokens')
 SUPP_LANG = [
@@ -57,17 +61,39 @@ def studentify_main(arguments):
 
         all other variables in the namespace (for new features)
         are going to be stored en the "flags" dictionary.
+        the state of the run (current shard root, files of the shard, line
+        cache) is kept apart in a run state, see make_run_state.
 
         we have 3 basic cases depending on the output variable:
         None   -> Modify files and/or folders in place
         file   -> Input must contain only one file
         folder -> Copy inputs in this folder
+
+        with a shard "i/N", only the files of the i-th slice of the inputs
+        are studentified and their list is written in a manifest file.
+        with verifyShards, no file is studentified: the given manifests are
+        checked to cover every input file exactly once.
+        with a cacheSize, the processing of identical lines is memoized
+        across all the files.
     """
     out_path = arguments.output
     in_paths = arguments.input
     # flags is the dictionary containing all other flags
     flags = {k: v for k, v in arguments.__dict__.items() if k not in ['func', 'input', 'output']}
 
+    if flags['verifyShards']:
+        try:
+            covered = verify_shards(in_paths, flags['verifyShards'])
+        except (OSError, ValueError, argparse.ArgumentTypeError) as inst:
+            print(inst)
+            sys.exit(1)
+        if not covered:
+            sys.exit(1)
+        return
+    if flags['shard'] is not None:
+        check_manifest_path(in_paths, flags)
+    state = make_run_state(flags)
+
     if out_path is None:
         if not flags['noBackup']:
             backup_path = os.path.abspath("studentify_backup")
@@ -84,7 +110,8 @@ def studentify_main(arguments):
             print("if you do not want backup, use the --noBackup flags")
         for i in in_paths:
             is_file = os.path.isfile(i)
-            studentify_one(i, i, is_file, flags)
+            state.shard_root = os.path.dirname(os.path.abspath(i))
+            studentify_one(i, i, is_file, flags, state)
     elif len(in_paths) == 1:
         if not arguments.force:
             try:
@@ -94,7 +121,8 @@ def studentify_main(arguments):
                 print("Consider using --force option if you want to overwrite the file")
                 sys.exit(1)
         is_file = os.path.isfile(out_path) if os.path.exists(out_path) else os.path.isfile(in_paths[0])
-        studentify_one(in_paths[0], out_path, is_file, flags)
+        state.shard_root = os.path.dirname(os.path.abspath(in_paths[0]))
+        studentify_one(in_paths[0], out_path, is_file, flags, state)
     else:
         if not arguments.force:
             try:
@@ -103,64 +131,279 @@ def studentify_main(arguments):
                 print(inst)
                 print("Consider using --force option if you want to overwrite the directory")
                 sys.exit(1)
-        studentify_multiple(in_paths, out_path, flags)
+        for i in in_paths:
+            state.shard_root = os.path.dirname(os.path.abspath(i))
+            studentify_one(i, out_path, False, flags, state)
+
+    if flags['shard'] is not None:
+        write_manifest(flags, state.shard_files)
+    if flags['debug'] and state.line_cache is not None:
+        print(line_cache_stats(state.line_cache))
+
+
+def make_run_state(flags, shard_root=None):
+    """ Create the state shared by all the files of one run.
+
+    The state is a namespace with the following attributes
+        shard_root: (string) folder the shard keys are relative to
+        shard_files: ([string]) keys of the files of the shard
+        default_manifests: ({string}) default manifest paths to skip
+        line_cache: (None or function) memoized process_line
+    """
+    shard = flags.get('shard')
+    cache_size = flags.get('cacheSize', 0)
+    return SimpleNamespace(
+        shard_root=shard_root,
+        shard_files=[],
+        default_manifests=default_manifest_paths(shard[1]) if shard is not None else set(),
+        line_cache=cached_line_processor(cache_size) if cache_size > 0 else None)
 
 
-def studentify_one(input_path, output_path, output_is_file, flags):
+def studentify_one(input_path, output_path, output_is_file, flags, state=None):
     """ Studentify the only file or folder given in input_path.
+
+    Without state, a new run state is created with input_path as top-level input.
     """
     input_path = os.path.abspath(input_path)
     output_path = os.path.abspath(output_path)
+    if state is None:
+        state = make_run_state(flags, os.path.dirname(input_path))
     # if we studentify in place
     if input_path == output_path:
         if os.path.isfile(input_path):
             assert output_is_file, f"{output_path} is actually an existing file"
+            if not in_shard(input_path, flags, state):
+                return
             if flags['debug']:
                 print(f"{input_path} -> {input_path}")
-            process_file(input_path, flags)
+            process_file(input_path, flags, state)
         if os.path.isdir(input_path):
             assert not output_is_file, f"{output_path} is actually an existing directory"
             lst = os.listdir(input_path)
             input_paths = [os.path.join(input_path, i) for i in lst]
-            studentify_multiple(input_paths, output_path, flags)
+            studentify_multiple(input_paths, output_path, flags, state)
     # if the input is a file, it depends on if output is a file also
     elif os.path.isfile(input_path):
         if output_is_file:
+            if not in_shard(input_path, flags, state):
+                return
             output_dir = os.path.dirname(output_path)
             if not os.path.exists(output_dir):
                 os.makedirs(output_dir)
             shutil.copy(input_path, output_path)
             if flags['debug']:
                 print(f"{input_path} -> {output_path}")
-            process_file(output_path, flags)
+            process_file(output_path, flags, state)
         else:
             output_file = os.path.join(output_path, os.path.basename(input_path))
-            studentify_one(input_path, output_file, True, flags)
+            studentify_one(input_path, output_file, True, flags, state)
     # else the input is a folder
     else:
         assert not output_is_file
         lst = os.listdir(input_path)
         input_paths = [os.path.join(input_path, i) for i in lst]
         newoutput_dir = os.path.join(output_path, os.path.basename(input_path))
-        studentify_multiple(input_paths, newoutput_dir, flags)
+        studentify_multiple(input_paths, newoutput_dir, flags, state)
 
 
-def studentify_multiple(input_paths, output_dir, flags):
+def studentify_multiple(input_paths, output_dir, flags, state=None):
     """ Studentify every input given in argument to the output directory.
     """
     for i in input_paths:
-        studentify_one(i, output_dir, False, flags)
+        studentify_one(i, output_dir, False, flags, state)
+
+
+def shard_key(file_path, root):
+    """ Identify a file by its path relative to root, with '/' separators.
+
+    The key does not depend on the machine, so every node computes the same
+    partition of the inputs.
+    """
+    return os.path.relpath(file_path, root).replace(os.sep, '/')
+
+
+def shard_of(key, shard_count):
+    """ Return the index of the shard a file key belongs to.
+
+    A stable hash is used (python's hash() is salted per process).
+    """
+    digest = hashlib.sha256(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count
+
+
+def in_shard(input_path, flags, state):
+    """ Check if a file belongs to the current shard.
+
+    Files of the shard are recorded in state.shard_files for the manifest.
+    Without shard, every file belongs to it. Default manifests written in the
+    current directory never belong to a shard, as it can be inside an input,
+    nor do the temporary files of shards running in place on the same tree.
+    """
+    if flags.get('shard') is None:
+        return True
+    index, count = flags['shard']
+    if input_path in state.default_manifests:
+        if flags['debug']:
+            print(f"{input_path} skipped (shard manifest)")
+        return False
+    if os.path.basename(input_path).startswith(TEMP_FILE_PREFIX):
+        if flags['debug']:
+            print(f"{input_path} skipped (temporary file of a running shard)")
+        return False
+    key = shard_key(input_path, state.shard_root)
+    if shard_of(key, count) != index:
+        if flags['debug']:
+            print(f"{input_path} skipped (not in shard {index}/{count})")
+        return False
+    state.shard_files.append(key)
+    return True
+
+
+def default_manifest_paths(shard_count):
+    """ Return the absolute paths of the default manifests of all the shards.
+    """
+    return {os.path.abspath(f"studentify_shard_{i}_of_{shard_count}.txt") for i in range(shard_count)}
+
+
+def manifest_path(flags):
+    """ Return the path of the manifest of the current shard.
+    """
+    if flags['manifest'] is not None:
+        return flags['manifest']
+    index, count = flags['shard']
+    return os.path.abspath(f"studentify_shard_{index}_of_{count}.txt")
+
 
+def check_manifest_path(in_paths, flags):
+    """ Exit if the manifest of the current shard cannot be written.
 
-def process_file(file_path, flags):
+    The manifest folder must be an existing writable folder, an existing
+    manifest is only overwritten with --force, and a manifest given with
+    --manifest must not be inside an input. This is checked before any file
+    is processed so that a whole run is not lost.
+    """
+    path = manifest_path(flags)
+    manifest_dir = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(manifest_dir) or not os.access(manifest_dir, os.W_OK):
+        print(f"manifest folder does not exist or is not writable: {manifest_dir}")
+        sys.exit(1)
+    if not flags['force']:
+        try:
+            check_path(path, False)
+        except argparse.ArgumentTypeError as inst:
+            print(inst)
+            print("Consider using --force option if you want to overwrite the manifest")
+            sys.exit(1)
+    if flags['manifest'] is not None:
+        path = os.path.abspath(path)
+        for i in in_paths:
+            i = os.path.abspath(i)
+            if os.path.commonpath([path, i]) == i:
+                print(f"manifest must not be inside an input: {path}")
+                sys.exit(1)
+
+
+def write_manifest(flags, keys):
+    """ Write the manifest of the current shard.
+
+    The first line is a header "# shard i/N", then one file key per line.
+    """
+    path = manifest_path(flags)
+    index, count = flags['shard']
+    with open(path, 'w', encoding='utf-8') as manifest:
+        manifest.write(f"# shard {index}/{count}\n")
+        for key in sorted(keys):
+            manifest.write(key + '\n')
+    if flags['debug']:
+        print(f"manifest of shard {index}/{count} written in: {path}")
+
+
+def read_manifest(path):
+    """ Read a manifest file and return ((index, count), keys).
+    """
+    with open(path, 'r', encoding='utf-8') as manifest:
+        header = manifest.readline().rstrip('\n')
+        if not header.startswith('# shard '):
+            raise ValueError(f"not a studentify manifest: {path}")
+        shard = parse_shard(header[len('# shard '):])
+        keys = [line.rstrip('\n') for line in manifest if line.strip()]
+    return shard, keys
+
+
+def input_keys(in_paths, excluded=()):
+    """ List the keys of all the files found in the inputs.
+
+    It follows the same walk as studentify_one, skipping the excluded paths
+    and the temporary files of process_file.
+    """
+    excluded = {os.path.abspath(p) for p in excluded}
+    keys = []
+    for i in in_paths:
+        root = os.path.dirname(os.path.abspath(i))
+        stack = [os.path.abspath(i)]
+        while stack:
+            path = stack.pop()
+            if path in excluded or os.path.basename(path).startswith(TEMP_FILE_PREFIX):
+                continue
+            if os.path.isfile(path):
+                keys.append(shard_key(path, root))
+            elif os.path.isdir(path):
+                stack.extend(os.path.join(path, p) for p in os.listdir(path))
+    return keys
+
+
+def verify_shards(in_paths, manifest_paths):
+    """ Check that the manifests cover every input file exactly once.
+
+    Print the problems found and return True if there are none. A key
+    shared by several inputs (e.g. a/course and b/course) must be covered
+    as many times as it is found in the inputs. Every key must also hash
+    to the shard of the manifest listing it.
+    """
+    shards = Counter()
+    covered = Counter()
+    errors = []
+    for path in manifest_paths:
+        (index, count), keys = read_manifest(path)
+        shards[(index, count)] += 1
+        covered.update(keys)
+        errors.extend(f"listed in shard {index}/{count} but belongs to shard {shard_of(k, count)}/{count}: {k}"
+                      for k in keys if shard_of(k, count) != index)
+    expected = Counter(input_keys(in_paths, manifest_paths))
+
+    counts = {count for _, count in shards}
+    if len(counts) > 1:
+        errors.append(f"manifests use different shard counts: {sorted(counts)}")
+    for count in counts:
+        missing_shards = [i for i in range(count) if (i, count) not in shards]
+        if missing_shards:
+            errors.append(f"missing manifests for shards {missing_shards} of {count}")
+    errors.extend(f"shard {i}/{n} has {c} manifests" for (i, n), c in sorted(shards.items()) if c > 1)
+    errors.extend(f"not covered: {k}" for k in sorted(expected - covered))
+    errors.extend(f"covered {c} times instead of {expected[k]}: {k}" for k, c in sorted(covered.items()) if c > expected[k] > 0)
+    errors.extend(f"not an input: {k}" for k in sorted(set(covered) - set(expected)))
+
+    for error in errors:
+        print(error)
+    if not errors:
+        print(f"{len(expected)} files covered exactly once by {len(manifest_paths)} manifests")
+    return not errors
+
+
+def process_file(file_path, flags, state=None):
     """ Process a file to remove lines containing some token.
 
     file_path must be an absolute path.
 
     1. Check if file is to be processed (matching filtypes in SUPP_LANG)
-    2. Open a temporary file
+    2. Open a temporary file next to the original one
     3. Process each line and write result in temporary file
     4. Rename temporary file into original file
+
+    The file is streamed line by line so memory use is bounded by the
+    longest line, not by the file size. With the largeFile flag, reads and
+    writes go through larger buffers to reduce the number of system calls on
+    huge generated files; it does not reduce the memory used by long lines.
     """
     assert os.path.isabs(file_path), "use an absolute path instead: " + file_path
     dummy_base, ext = os.path.splitext(file_path)
@@ -170,17 +413,27 @@ def process_file(file_path, flags):
             print(f"No supported language found for file {file_path}")
     else:
         lang = file_lang[0]
-        # open a temporary file
-        with open(file_path, 'r+') as original_file, tempfile.NamedTemporaryFile(mode='w', delete=False) as temp_file:
-            temp_path = temp_file.name
-            in_block = {'delete': False, 'comment': False, 'replace': False, 'student': False}
-            # process each line of the file
-            for line in original_file:
-                new_line, in_block = process_line(line, lang, in_block, flags)
-                temp_file.write(new_line)
-        # rename temp file into original
-        shutil.copystat(file_path, temp_path)
-        shutil.move(temp_path, file_path)
+        buffer_size = LARGE_FILE_BUFFER_SIZE if flags.get('largeFile') else -1
+        # open a temporary file in the same directory so that the final rename
+        # does not copy the whole output across filesystems
+        temp_file = tempfile.NamedTemporaryFile(mode='w', buffering=buffer_size, delete=False,
+                                                dir=os.path.dirname(file_path), prefix=TEMP_FILE_PREFIX)
+        temp_path = temp_file.name
+        try:
+            with open(file_path, 'r', buffering=buffer_size) as original_file, temp_file:
+                in_block = {'delete': False, 'comment': False, 'replace': False, 'student': False}
+                line_processor = process_line if state is None or state.line_cache is None else state.line_cache
+                # process each line of the file
+                for line in original_file:
+                    new_line, in_block = line_processor(line, lang, in_block, flags)
+                    temp_file.write(new_line)
+            # rename temp file into original
+            shutil.copystat(file_path, temp_path)
+            os.replace(temp_path, file_path)
+        except BaseException:
+            # do not leave the temporary file in the user's tree
+            os.unlink(temp_path)
+            raise
 
 
 def process_line(line, lang, in_block, flags):
@@ -241,6 +494,42 @@ def process_line(line, lang, in_block, flags):
     return new_line, in_block
 
 
+def cached_line_processor(maxsize):
+    """ Return a memoized version of process_line keeping at most maxsize lines.
+
+    The result of process_line only depends on the line, the language, the
+    noBlankLine and clean flags and the in_block state, so these are the
+    cache key. The returned function has the same signature as process_line
+    and exposes the cache_info of the underlying lru_cache.
+    """
+    langs = {lang.name: lang for lang in SUPP_LANG}
+    block_types = list(TOKEN_TYPES)
+
+    @lru_cache(maxsize=maxsize)
+    def cached(line, lang_name, no_blank_line, clean, in_block):
+        flags = {'noBlankLine': no_blank_line, 'clean': clean}
+        new_line, new_block = process_line(line, langs[lang_name], dict(zip(block_types, in_block)), flags)
+        return new_line, tuple(new_block[k] for k in block_types)
+
+    def processor(line, lang, in_block, flags):
+        new_line, new_block = cached(line, lang.name, flags['noBlankLine'], flags['clean'],
+                                     tuple(in_block[k] for k in block_types))
+        return new_line, dict(zip(block_types, new_block))
+
+    processor.cache_info = cached.cache_info
+    return processor
+
+
+def line_cache_stats(line_processor):
+    """ Describe the hits and misses of a cached line processor.
+    """
+    info = line_processor.cache_info()
+    total = info.hits + info.misses
+    rate = 100 * info.hits / total if total else 0
+    return f"line cache: {info.hits} hits, {info.misses} misses ({rate:.1f}% hit rate), " \
+           f"{info.currsize}/{info.maxsize} lines cached"
+
+
 def process_block_structure(line, in_block, tokens, processing_functions):
     """ Process a line in block (delete block, comment block, ...).
     inputs:
@@ -295,17 +584,17 @@ def after_token(keep_indent, lstripped, token, line):
     The token must be present to not raise an error.
     """
     new_line = line.split(token, 1)[1]
-    if lstripped:
+    if lstripped or keep_indent:
         new_line = new_line.lstrip()
     if keep_indent:
-        new_line = indent_chars(line) + new_line.lstrip()
+        new_line = indent_chars(line) + new_line
     return new_line
 
 
 def remove_end(token, line):
     """ Remove everything starting from the token.
     """
-    return line.split(token)[0].rstrip() + '\n'
+    return line.split(token, 1)[0].rstrip() + '\n'
 
 
 def add_start(token, line):
@@ -344,6 +633,30 @@ def check_path(path, should_exist):
     return path
 
 
+def non_negative_int(value):
+    """ Check that a value is a non-negative integer and return it.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("not an integer: " + value) from None
+    if number < 0:
+        raise argparse.ArgumentTypeError("must not be negative: " + value)
+    return number
+
+
+def parse_shard(spec):
+    """ Parse a shard "i/N" and return (i, N) with 0 <= i < N.
+    """
+    try:
+        index, count = (int(x) for x in spec.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must be of the form i/N: " + spec) from None
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError("shard index must be in [0, N): " + spec)
+    return index, count
+
+
 # arguments configuration
 parser = argparse.ArgumentParser()
 parser.set_defaults(func=studentify_main)
@@ -363,6 +676,16 @@ parser.add_argument('--noBackup', action='store_true',
                     help='do not create backup when studentifying in place')
 parser.add_argument('--clean', action='store_true',
                     help='create clean version of the file')
+parser.add_argument('--largeFile', action='store_true',
+                    help='use large read/write buffers for huge (e.g. generated) files')
+parser.add_argument('--cacheSize', type=non_negative_int, default=0,
+                    help='memoize the processing of up to CACHESIZE distinct lines (0 disables the cache)')
+parser.add_argument('--shard', type=parse_shard,
+                    help='only studentify the i-th of N disjoint slices of the input files (i/N, 0 <= i < N)')
+parser.add_argument('--manifest',
+                    help='manifest file listing the files of the shard (default: studentify_shard_i_of_N.txt)')
+parser.add_argument('--verifyShards', nargs='+', metavar='MANIFEST',
+                    help='check that the shard manifests cover every input file exactly once')
 
 if __name__ == '__main__':
     args = parser.parse_args()
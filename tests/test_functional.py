@@ -5,6 +5,10 @@ from pathlib import Path
 from typing import List, Optional
 import pytest
 
+# Add parent directory to path to import studentify
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import studentify  # pylint: disable=wrong-import-position
+
 
 @pytest.fixture
 def repo_root():
@@ -65,6 +69,13 @@ def run_studentify(
     )
 
 
+def run_studentify_args(studentify_script: Path, args: List[str], cwd: Optional[Path] = None) -> subprocess.CompletedProcess:
+    """Run the studentify script with raw command-line arguments."""
+    return subprocess.run(  # nosec B404
+        [sys.executable, str(studentify_script)] + args,
+        capture_output=True, text=True, shell=False, cwd=cwd)
+
+
 def assert_studentify_output(
     result: subprocess.CompletedProcess,
     actual_file: Path,
@@ -165,3 +176,322 @@ def test_studentify_in_place(tmp_path, studentify_script, fixtures_dir):
     result = run_studentify(studentify_script, test_file)
     assert_studentify_output(result, test_file, expected_file,
                             "In-place modification doesn't match expected output")
+
+
+def test_studentify_cpp_line_cache(tmp_path, studentify_script, fixtures_dir):
+    """Test studentify with the line cache enabled.
+
+    The output must be the same as without cache and the debug output must
+    report the cache hit rate.
+
+    Args:
+        tmp_path: Pytest fixture providing a temporary directory
+        studentify_script: Path to the studentify.py script
+        fixtures_dir: Path to the test fixtures directory
+    """
+    input_file = fixtures_dir / "cpp" / "input.cpp"
+    expected_file = fixtures_dir / "cpp" / "expected.cpp"
+    output_file = tmp_path / "result.cpp"
+
+    result = run_studentify(studentify_script, input_file, output_file, ["--cacheSize", "16", "--debug"])
+    assert_studentify_output(result, output_file, expected_file,
+                            "Output with line cache doesn't match expected student version")
+    assert "line cache:" in result.stdout
+
+
+def peak_rss_of_studentify(studentify_script: Path, input_file: Path, extra_args: List[str]) -> int:
+    """Run studentify in place on a file and return the peak RSS of the process.
+
+    The peak resident set size is reported by the child itself through
+    resource.getrusage, in kilobytes (Linux only).
+    """
+    code = (
+        "import resource, runpy, sys\n"
+        "sys.argv = sys.argv[1:]\n"
+        "runpy.run_path(sys.argv[0], run_name='__main__')\n"
+        "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n"
+    )
+    cmd = [sys.executable, "-c", code, str(studentify_script), str(input_file), "--noBackup"] + extra_args
+    result = subprocess.run(cmd, capture_output=True, text=True, shell=False, check=True)  # nosec B404
+    return int(result.stdout.strip().splitlines()[-1])
+
+
+def write_generated_file(path: Path, nb_repeats: int) -> None:
+    """Write a generated-looking python file made of tagged and untagged lines."""
+    block = (
+        "data = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]\n"
+        "value = compute(data) #!!\n"
+        "result = value * 2 #++ result = None #++ not a second split\n"
+        "#<??\n"
+        "table.append(value)\n"
+        "#>??\n"
+    )
+    with open(path, "w", encoding="utf-8") as out:
+        for _ in range(nb_repeats):
+            out.write(block)
+
+
+@pytest.mark.slow
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="ru_maxrss is only reported in kB on Linux")
+def test_studentify_large_file_memory(tmp_path, studentify_script):
+    """Test that the peak memory of --largeFile does not depend on the number of lines.
+
+    A small and a 16 times larger generated file made of short lines are
+    processed in place; the difference between the two peak RSS must stay
+    well below the size of the larger file. Memory is still bounded by the
+    longest line, which this test does not cover.
+
+    Args:
+        tmp_path: Pytest fixture providing a temporary directory
+        studentify_script: Path to the studentify.py script
+    """
+    small_file = tmp_path / "small.py"
+    large_file = tmp_path / "large.py"
+    write_generated_file(small_file, 5_000)
+    write_generated_file(large_file, 80_000)
+    large_size_kb = large_file.stat().st_size // 1024
+
+    small_rss = peak_rss_of_studentify(studentify_script, small_file, ["--largeFile"])
+    large_rss = peak_rss_of_studentify(studentify_script, large_file, ["--largeFile"])
+
+    assert large_rss - small_rss < large_size_kb // 4, \
+        f"peak RSS grew from {small_rss} kB to {large_rss} kB for a {large_size_kb} kB file"
+
+    content = large_file.read_text(encoding="utf-8")
+    assert "#!!" not in content
+    assert "result = None #++ not a second split\n" in content
+
+
+def test_studentify_removes_temporary_file_on_error(tmp_path, studentify_script):
+    """Test that no temporary file is left next to a file that fails to process.
+
+    Args:
+        tmp_path: Pytest fixture providing a temporary directory
+        studentify_script: Path to the studentify.py script
+    """
+    bad_file = tmp_path / "bad.py"
+    bad_file.write_bytes(b"x = 1 #!!\n\xff\xfe not utf-8\n")
+    original = bad_file.read_bytes()
+
+    result = subprocess.run(  # nosec B404
+        [sys.executable, "-X", "utf8", str(studentify_script), str(bad_file), "--noBackup"],
+        capture_output=True, text=True, shell=False)
+
+    assert result.returncode != 0
+    assert [p.name for p in tmp_path.iterdir()] == ["bad.py"]
+    assert bad_file.read_bytes() == original
+
+
+def test_studentify_shards(tmp_path, studentify_script, fixtures_dir):
+    """Test that shards produce disjoint slices covering the whole output tree.
+
+    Every shard is run into its own output folder with its own manifest. The
+    union of the shard outputs must be the output of a run without shard, and
+    --verifyShards must accept all the manifests but reject an incomplete set.
+
+    Args:
+        tmp_path: Pytest fixture providing a temporary directory
+        studentify_script: Path to the studentify.py script
+        fixtures_dir: Path to the test fixtures directory
+    """
+    course = tmp_path / "course"
+    content = (fixtures_dir / "cpp" / "input.cpp").read_text(encoding="utf-8")
+    for i in range(4):
+        (course / f"tp{i}").mkdir(parents=True)
+        for j in range(5):
+            (course / f"tp{i}" / f"file{j}.cpp").write_text(content, encoding="utf-8")
+        (course / f"tp{i}" / "notes.txt").write_text("notes", encoding="utf-8")
+
+    def output_files(folder):
+        return {p.relative_to(folder): p.read_text(encoding="utf-8") for p in folder.rglob("*") if p.is_file()}
+
+    result = run_studentify_args(studentify_script, [str(course), "-o", str(tmp_path / "full")])
+    assert result.returncode == 0, result.stderr
+    expected = output_files(tmp_path / "full")
+
+    manifests = []
+    merged = {}
+    for i in range(3):
+        manifest = tmp_path / f"shard{i}.txt"
+        manifests.append(str(manifest))
+        result = run_studentify_args(studentify_script, [str(course), "-o", str(tmp_path / f"shard{i}"),
+                                                         "--shard", f"{i}/3", "--manifest", str(manifest)])
+        assert result.returncode == 0, result.stderr
+        files = output_files(tmp_path / f"shard{i}") if (tmp_path / f"shard{i}").exists() else {}
+        assert not set(files) & set(merged), "shards are not disjoint"
+        merged.update(files)
+    assert merged == expected
+
+    result = run_studentify_args(studentify_script, [str(course), "--verifyShards"] + manifests)
+    assert result.returncode == 0, result.stdout
+    result = run_studentify_args(studentify_script, [str(course), "--verifyShards"] + manifests[:2])
+    assert result.returncode == 1
+    assert "missing manifests for shards [2] of 3" in result.stdout
+    assert "not covered:" in result.stdout
+
+
+def test_studentify_shards_in_place_default_manifests(tmp_path, studentify_script, fixtures_dir):
+    """Test sharding in place from inside the input with the default manifests.
+
+    The default manifests are then written inside the input folder; they must
+    neither be studentified by the other shards nor be expected as inputs.
+
+    Args:
+        tmp_path: Pytest fixture providing a temporary directory
+        studentify_script: Path to the studentify.py script
+        fixtures_dir: Path to the test fixtures directory
+    """
+    course = tmp_path / "course"
+    course.mkdir()
+    content = (fixtures_dir / "cpp" / "input.cpp").read_text(encoding="utf-8")
+    for j in range(6):
+        (course / f"file{j}.cpp").write_text(content, encoding="utf-8")
+
+    for i in range(2):
+        result = run_studentify_args(studentify_script, [".", "--noBackup", "--shard", f"{i}/2"], cwd=course)
+        assert result.returncode == 0, result.stderr
+    manifests = ["studentify_shard_0_of_2.txt", "studentify_shard_1_of_2.txt"]
+    assert "studentify_shard_0_of_2.txt" not in (course / manifests[1]).read_text(encoding="utf-8")
+
+    result = run_studentify_args(studentify_script, [".", "--verifyShards"] + manifests, cwd=course)
+    assert result.returncode == 0, result.stdout
+
+    # Manifests are not overwritten without --force
+    result = run_studentify_args(studentify_script, [".", "--noBackup", "--shard", "0/2"], cwd=course)
+    assert result.returncode == 1
+    assert "--force" in result.stdout
+    result = run_studentify_args(studentify_script, [".", "--noBackup", "--shard", "0/2", "--force"], cwd=course)
+    assert result.returncode == 0, result.stderr
+
+    # A custom manifest must not be inside an input
+    result = run_studentify_args(studentify_script, [".", "--noBackup", "--shard", "0/2", "--manifest", "m.txt"],
+                                 cwd=course)
+    assert result.returncode == 1
+    assert "manifest must not be inside an input" in result.stdout
+
+
+def test_studentify_shards_same_basename(tmp_path, studentify_script):
+    """Test verifying shards of inputs sharing the same basename.
+
+    Args:
+        tmp_path: Pytest fixture providing a temporary directory
+        studentify_script: Path to the studentify.py script
+    """
+    inputs = [tmp_path / "a" / "course", tmp_path / "b" / "course"]
+    for folder in inputs:
+        folder.mkdir(parents=True)
+        (folder / "m.py").write_text("x = 1 #!!\n", encoding="utf-8")
+    manifest = tmp_path / "m0.txt"
+    args = [str(i) for i in inputs]
+
+    result = run_studentify_args(studentify_script, args + ["-o", str(tmp_path / "out"), "--shard", "0/1",
+                                                            "--manifest", str(manifest)])
+    assert result.returncode == 0, result.stderr
+    result = run_studentify_args(studentify_script, args + ["--verifyShards", str(manifest)])
+    assert result.returncode == 0, result.stdout
+
+    result = run_studentify_args(studentify_script, args[:1] + ["--verifyShards", str(manifest)])
+    assert result.returncode == 1
+    assert "covered 2 times instead of 1: course/m.py" in result.stdout
+
+
+def test_studentify_verify_shards_invalid_manifests(tmp_path, studentify_script):
+    """Test that invalid manifests are reported without a traceback.
+
+    Args:
+        tmp_path: Pytest fixture providing a temporary directory
+        studentify_script: Path to the studentify.py script
+    """
+    course = tmp_path / "course"
+    course.mkdir()
+    no_header = tmp_path / "no_header.txt"
+    no_header.write_text("course/m.py\n", encoding="utf-8")
+    bad_header = tmp_path / "bad_header.txt"
+    bad_header.write_text("# shard 3/2\n", encoding="utf-8")
+
+    for manifest in [tmp_path / "missing.txt", no_header, bad_header]:
+        result = run_studentify_args(studentify_script, [str(course), "--verifyShards", str(manifest)])
+        assert result.returncode == 1
+        assert "Traceback" not in result.stderr
+        assert result.stdout
+
+
+def test_studentify_verify_shards_wrong_shard(tmp_path, studentify_script):
+    """Test that a file listed in a shard it does not hash to is reported.
+
+    The two manifests swap their files: every input is still covered
+    exactly once, but in the wrong shard.
+
+    Args:
+        tmp_path: Pytest fixture providing a temporary directory
+        studentify_script: Path to the studentify.py script
+    """
+    course = tmp_path / "course"
+    course.mkdir()
+    keys = {0: [], 1: []}
+    for j in range(10):
+        key = f"course/file{j}.py"
+        (tmp_path / key).write_text("x = 1\n", encoding="utf-8")
+        keys[studentify.shard_of(key, 2)].append(key)
+    assert keys[0] and keys[1]
+
+    manifests = []
+    for i in range(2):
+        manifest = tmp_path / f"m{i}.txt"
+        manifest.write_text(f"# shard {i}/2\n" + "".join(k + "\n" for k in keys[1 - i]), encoding="utf-8")
+        manifests.append(str(manifest))
+
+    result = run_studentify_args(studentify_script, [str(course), "--verifyShards"] + manifests)
+    assert result.returncode == 1
+    assert f"listed in shard 0/2 but belongs to shard 1/2: {keys[1][0]}" in result.stdout
+
+
+def test_studentify_shards_skip_temporary_files(tmp_path, studentify_script):
+    """Test that temporary files of shards running in place are not inputs.
+
+    A leftover temporary file simulates another shard processing the same
+    tree at the same time.
+
+    Args:
+        tmp_path: Pytest fixture providing a temporary directory
+        studentify_script: Path to the studentify.py script
+    """
+    course = tmp_path / "course"
+    course.mkdir()
+    for j in range(6):
+        (course / f"file{j}.py").write_text("x = 1 #!!\n", encoding="utf-8")
+    for j in range(6):
+        (course / f"{studentify.TEMP_FILE_PREFIX}tmp{j}").write_text("partial", encoding="utf-8")
+
+    manifests = []
+    for i in range(2):
+        manifest = tmp_path / f"m{i}.txt"
+        manifests.append(str(manifest))
+        result = run_studentify_args(studentify_script, [str(course), "--noBackup", "--shard", f"{i}/2",
+                                                         "--manifest", str(manifest)])
+        assert result.returncode == 0, result.stderr
+        assert studentify.TEMP_FILE_PREFIX not in manifest.read_text(encoding="utf-8")
+
+    result = run_studentify_args(studentify_script, [str(course), "--verifyShards"] + manifests)
+    assert result.returncode == 0, result.stdout
+
+
+def test_studentify_shard_manifest_folder_missing(tmp_path, studentify_script):
+    """Test that a manifest in a missing folder is refused before processing.
+
+    Args:
+        tmp_path: Pytest fixture providing a temporary directory
+        studentify_script: Path to the studentify.py script
+    """
+    course = tmp_path / "course"
+    course.mkdir()
+    (course / "m.py").write_text("x = 1 #!!\n", encoding="utf-8")
+    output = tmp_path / "out"
+
+    result = run_studentify_args(studentify_script, [str(course), "-o", str(output), "--shard", "0/1",
+                                                     "--manifest", str(tmp_path / "nodir" / "m.txt")])
+
+    assert result.returncode == 1
+    assert "Traceback" not in result.stderr
+    assert "manifest folder does not exist or is not writable" in result.stdout
+    assert not output.exists()
@@ -1,7 +1,10 @@
 """Unit tests for studentify.py functions"""
+import argparse
 import sys
 from pathlib import Path
 
+import pytest
+
 # Add parent directory to path to import studentify
 sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
 import studentify
@@ -73,6 +76,8 @@ def test_remove_end():
     assert studentify.remove_end("//!!", "line //!!\n") == "line\n"  # Strips trailing space
     assert studentify.remove_end("//??", "code //??comment\n") == "code\n"
     assert studentify.remove_end("//++", "old //++ new\n") == "old\n"
+    # Only the first occurrence of the token matters
+    assert studentify.remove_end("//!!", "a //!! b //!! c\n") == "a\n"
 
 
 def test_after_token():
@@ -85,6 +90,14 @@ def test_after_token():
     result = studentify.after_token(True, True, "//++", "  old //++ new\n")
     assert result == "  new\n"
 
+    # Keep unstripped text after the token
+    result = studentify.after_token(False, False, "//++", "old //++ new\n")
+    assert result == " new\n"
+
+    # Only split on the first occurrence of the token
+    result = studentify.after_token(True, True, "//++", "old //++ new //++ x\n")
+    assert result == "new //++ x\n"
+
 
 def test_add_start_and_remove_end():
     """Test add_start_and_remove_end function."""
@@ -168,3 +181,74 @@ def test_language_detection():
 
     # JavaScript
     assert any(lang.name == "javascript" and ".js" in lang.extensions for lang in studentify.SUPP_LANG)
+
+
+def test_parse_shard():
+    """Test parsing of the shard specification."""
+    assert studentify.parse_shard("0/1") == (0, 1)
+    assert studentify.parse_shard("3/4") == (3, 4)
+
+    for spec in ["4/4", "-1/4", "1/0", "1", "a/b", "1/2/3"]:
+        with pytest.raises(argparse.ArgumentTypeError):
+            studentify.parse_shard(spec)
+
+
+def test_non_negative_int():
+    """Test validation of non-negative integer arguments."""
+    assert studentify.non_negative_int("0") == 0
+    assert studentify.non_negative_int("1024") == 1024
+
+    for value in ["-5", "1.5", "abc"]:
+        with pytest.raises(argparse.ArgumentTypeError):
+            studentify.non_negative_int(value)
+
+
+def test_shard_of():
+    """Test that files are deterministically partitioned between shards."""
+    keys = [f"course/tp{i}/file{j}.py" for i in range(10) for j in range(10)]
+
+    # Stable across calls, in range and using every shard
+    shards = [studentify.shard_of(k, 4) for k in keys]
+    assert shards == [studentify.shard_of(k, 4) for k in keys]
+    assert set(shards) == {0, 1, 2, 3}
+    assert all(studentify.shard_of(k, 1) == 0 for k in keys)
+
+
+def test_shard_key(tmp_path):
+    """Test that shard keys are relative paths with / separators."""
+    file_path = tmp_path / "course" / "tp1" / "main.py"
+    assert studentify.shard_key(str(file_path), str(tmp_path)) == "course/tp1/main.py"
+
+
+@pytest.mark.parametrize("clean", [False, True])
+def test_cached_line_processor(clean):
+    """Test that the cached line processor matches process_line."""
+    fixture = Path(__file__).resolve().parent / "fixtures" / "cpp" / "input.cpp"
+    lines = fixture.read_text(encoding="utf-8").splitlines(keepends=True) * 2
+    lang = next(lang for lang in studentify.SUPP_LANG if lang.name == "c/c++")
+    flags = {'noBlankLine': False, 'clean': clean}
+    processor = studentify.cached_line_processor(64)
+
+    expected_block = {'delete': False, 'comment': False, 'replace': False, 'student': False}
+    in_block = dict(expected_block)
+    for line in lines:
+        expected_line, expected_block = studentify.process_line(line, lang, expected_block, flags)
+        new_line, in_block = processor(line, lang, in_block, flags)
+        assert new_line == expected_line
+        assert in_block == expected_block
+
+    info = processor.cache_info()
+    assert info.hits >= len(lines) // 2
+    assert info.currsize <= 64
+    assert "hit rate" in studentify.line_cache_stats(processor)
+
+
+def test_studentify_one_without_run_state(tmp_path):
+    """Test studentify_one called directly with only the basic flags."""
+    fixtures = Path(__file__).resolve().parent / "fixtures" / "cpp"
+    output_file = tmp_path / "result.cpp"
+    flags = {'debug': False, 'noBlankLine': False, 'clean': False}
+
+    studentify.studentify_one(str(fixtures / "input.cpp"), str(output_file), True, flags)
+
+    assert output_file.read_text(encoding="utf-8") == (fixtures / "expected.cpp").read_text(encoding="utf-8")